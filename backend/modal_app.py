@@ -3,21 +3,151 @@ Melingo Shopify Engagement System - FastAPI Server
 AI-powered e-commerce engagement system
 """
 
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Deque, Tuple, Union
+from collections import Counter, deque, defaultdict
+import asyncio
 import time
-import json
+import orjson
 import os
-from datetime import datetime
+import hashlib
+import re
+import logging
 from pydantic import BaseModel
 from dotenv import load_dotenv
+from redis.asyncio import Redis
+from redis.commands.core import AsyncScript
+from openai import AsyncOpenAI, APIConnectionError, InternalServerError, RateLimitError
 
 # Load environment variables
 load_dotenv()
 
-# In-memory storage for sessions
-sessions_store: Dict[str, Dict] = {}
+# Verbose logging only in development; hot-path messages are DEBUG and cost nothing otherwise
+logging.basicConfig(format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+log = logging.getLogger("melingo")
+log.setLevel(logging.DEBUG if os.getenv("ENVIRONMENT") == "development" else logging.WARNING)
+
+# Redis-backed session storage, shared across containers
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL = 3600
+AI_CACHE_TTL = 600
+
+# One client per worker so HTTPS connections to OpenAI are pooled and reused.
+# SDK retries are disabled: get_ai_decision retries itself, outside the semaphore,
+# and each attempt is capped at OPENAI_TIMEOUT seconds
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+OPENAI_TIMEOUT = 10
+openai_client: Optional[AsyncOpenAI] = (
+    AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0, timeout=OPENAI_TIMEOUT)
+    if OPENAI_API_KEY else None
+)
+
+# Bound concurrent OpenAI requests per worker; retry transient failures with backoff
+OPENAI_MAX_CONCURRENCY = 20
+OPENAI_MAX_ATTEMPTS = 5
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+# Prompt is rendered with str.format_map; defaults cover fields missing from the analysis
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a smart e-commerce engagement assistant."}
+PROMPT_DEFAULTS = {
+    "page_views": 0,
+    "clicks": 0,
+    "product_page_views": 0,
+    "cart_actions": 0,
+    "session_duration": 0,
+    "current_page": "unknown",
+    "has_cart_items": False
+}
+PROMPT_TEMPLATE = """
+You are an AI assistant helping an e-commerce store engage customers at the right moment.
+
+Analyze this user session data and decide if you should show an engagement message:
+
+Session Analysis:
+- Total page views: {page_views}
+- Total clicks: {clicks}
+- Products viewed: {product_page_views}
+- Cart interactions: {cart_actions}
+- Session duration: {session_duration:.1f} seconds
+- Current page type: {current_page}
+- Has items in cart: {has_cart_items}
+
+Rules for engagement:
+1. Don't be annoying - only show messages when it adds value
+2. Consider user behavior patterns (hesitation, high engagement, etc.)
+3. Time messages appropriately (not too early, not too late)
+4. Personalize based on behavior
+
+Respond in JSON format:
+{{
+    "should_show_message": true/false,
+    "message": "Your personalized message here (max 50 words)",
+    "reasoning": "Brief explanation of why",
+    "trigger_type": "discount" | "help" | "urgency" | "recommendation" | null
+}}
+"""
+
+# Used to salvage fields when the model's reply is not valid JSON (e.g. truncated)
+SHOW_MESSAGE_RE = re.compile(r'"should_show_message":\s*true')
+MESSAGE_RE = re.compile(r'"message":\s*"([^"]+)"')
+TRIGGER_TYPE_RE = re.compile(r'"trigger_type":\s*"([^"]+)"')
+
+# /track only enqueues; a background task writes batches to Redis
+TRACK_FLUSH_INTERVAL = 0.02
+TRACK_FLUSH_BATCH_SIZE = 500
+# While Redis is unreachable: cap the in-memory backlog (new events get a 503)
+# and back off exponentially between flush attempts
+TRACK_QUEUE_MAX = 10000
+TRACK_FLUSH_MAX_BACKOFF = 5.0
+
+# Sessions keep running counters plus only the last few events, so
+# per-session memory stays constant however long the session runs
+RECENT_EVENTS = 5
+EVENT_COUNTERS = {"page_view": "page_views", "click": "clicks", "add_to_cart": "cart_actions"}
+PAGE_VIEW_COUNTERS = {"product": "product_page_views", "cart": "cart_page_views"}
+
+# Workers flush independently, so a session's batches can reach Redis out of
+# order. Only move the first/last event fields when the batch really extends them.
+UPDATE_EVENT_BOUNDS_LUA = """
+local first = redis.call('HGET', KEYS[1], 'first_event_at')
+if not first or tonumber(ARGV[1]) < tonumber(first) then
+    redis.call('HSET', KEYS[1], 'first_event_at', ARGV[1])
+end
+local last = redis.call('HGET', KEYS[1], 'last_event_at')
+if not last or tonumber(ARGV[2]) >= tonumber(last) then
+    redis.call('HSET', KEYS[1], 'last_event_at', ARGV[2], 'current_page', ARGV[3])
+end
+return 1
+"""
+
+redis_client: Optional[Redis] = None
+update_event_bounds: Optional[AsyncScript] = None
+track_queue: Deque[Tuple["TrackingEvent", bytes]] = deque()
+flush_task: Optional[asyncio.Task] = None
+flush_stop = asyncio.Event()
+flush_failures = 0
+rejected_events = 0
+
+def session_events_key(session_id: str) -> str:
+    return f"sess:{session_id}:events"
+
+def session_meta_key(session_id: str) -> str:
+    return f"sess:{session_id}:meta"
+
+def ai_cache_key(analysis: Dict) -> str:
+    """Fingerprint the analysis fields the AI decision depends on"""
+    # Duration is bucketed to 10s so similar sessions share a cache entry
+    fingerprint = repr((
+        analysis["page_views"],
+        analysis["clicks"],
+        analysis["product_page_views"],
+        analysis["cart_actions"],
+        int(analysis["session_duration"] // 10),
+        analysis["current_page"],
+        analysis["has_cart_items"],
+    ))
+    return f"ai:{hashlib.blake2b(fingerprint.encode()).hexdigest()}"
 
 # Pydantic models
 class TrackingEvent(BaseModel):
@@ -36,6 +166,18 @@ class AIResponse(BaseModel):
     message: Optional[str] = None
     trigger_type: Optional[str] = None
 
+# Response models let FastAPI serialise straight to JSON bytes via pydantic-core
+class TrackResponse(BaseModel):
+    status: str
+    session_id: str
+
+class HealthResponse(BaseModel):
+    status: str
+    timestamp: int
+
+class ErrorResponse(BaseModel):
+    error: str
+
 # Create FastAPI app
 app = FastAPI(
     title="Melingo Engagement API",
@@ -52,175 +194,274 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+async def write_tracked_events(batch: List[Tuple[TrackingEvent, bytes]]):
+    """Write a batch of queued events to Redis in a single pipeline"""
+    events_by_session: Dict[str, List[TrackingEvent]] = defaultdict(list)
+    bodies_by_session: Dict[str, List[bytes]] = defaultdict(list)
+    for event, body in batch:
+        events_by_session[event.session_id].append(event)
+        bodies_by_session[event.session_id].append(body)
+    
+    # Wall-clock (not loop.time(), which is per-process) so it is comparable
+    # across workers; integer milliseconds keep the stored values compact
+    now = int(time.time() * 1000)
+    
+    # Events are stored as the raw request bodies and only decoded on /analyze.
+    # HSETNX makes session creation atomic across concurrent writers. The batch
+    # runs as MULTI/EXEC so a failed attempt never leaves half-applied counters.
+    async with redis_client.pipeline(transaction=True) as pipe:
+        for session_id, events in events_by_session.items():
+            events_key = session_events_key(session_id)
+            meta_key = session_meta_key(session_id)
+            
+            counters = Counter(total_events=len(events))
+            for event in events:
+                counter = EVENT_COUNTERS.get(event.event_type)
+                if counter:
+                    counters[counter] += 1
+                if event.event_type == "page_view" and event.page_type in PAGE_VIEW_COUNTERS:
+                    counters[PAGE_VIEW_COUNTERS[event.page_type]] += 1
+            
+            pipe.rpush(events_key, *bodies_by_session[session_id])
+            pipe.ltrim(events_key, -RECENT_EVENTS, -1)
+            pipe.hsetnx(meta_key, "created_at", now)
+            # Analysis reads timestamps and page type from these validated
+            # fields; the stored raw bodies are only echoed back as-is
+            first_event_at = min(event.timestamp for event in events)
+            last_event = max(events, key=lambda event: event.timestamp)
+            # Queued on the pipeline; the await only buffers the EVALSHA
+            await update_event_bounds(
+                keys=[meta_key],
+                args=[first_event_at, last_event.timestamp, last_event.page_type or "unknown"],
+                client=pipe
+            )
+            pipe.hset(meta_key, "last_activity", now)
+            for counter, count in counters.items():
+                pipe.hincrby(meta_key, counter, count)
+            pipe.expire(events_key, SESSION_TTL)
+            pipe.expire(meta_key, SESSION_TTL)
+        await pipe.execute()
+
+async def drain_track_queue():
+    """Flush everything currently queued, in batches"""
+    global flush_failures, rejected_events
+    while track_queue:
+        batch = [track_queue.popleft() for _ in range(min(len(track_queue), TRACK_FLUSH_BATCH_SIZE))]
+        try:
+            await write_tracked_events(batch)
+        except Exception:
+            # Requeue in order and retry later rather than dropping events.
+            # Each attempt is all-or-nothing (MULTI/EXEC), but delivery is still
+            # at-least-once: if EXEC was applied and only its reply was lost, the
+            # retried batch is written (and counted) a second time.
+            track_queue.extendleft(reversed(batch))
+            if flush_failures == 0:
+                log.exception("Flush events error, retrying with backoff (%d queued)", len(track_queue))
+            flush_failures += 1
+            return
+    
+    if flush_failures:
+        log.warning("Redis flush recovered after %d failed attempts, %d events rejected meanwhile",
+                    flush_failures, rejected_events)
+        flush_failures = 0
+        rejected_events = 0
+
+async def flush_tracked_events():
+    """Background task: periodically flush queued tracking events until stopped"""
+    while not flush_stop.is_set():
+        delay = TRACK_FLUSH_INTERVAL
+        if flush_failures:
+            delay = min(TRACK_FLUSH_INTERVAL * 2 ** flush_failures, TRACK_FLUSH_MAX_BACKOFF)
+        try:
+            # Wakes early on shutdown so a long backoff doesn't delay it
+            await asyncio.wait_for(flush_stop.wait(), timeout=delay)
+            break
+        except asyncio.TimeoutError:
+            pass
+        await drain_track_queue()
+
+@app.on_event("startup")
+async def startup_event():
+    global redis_client, update_event_bounds, flush_task, flush_failures
+    redis_client = Redis.from_url(REDIS_URL)
+    update_event_bounds = redis_client.register_script(UPDATE_EVENT_BOUNDS_LUA)
+    flush_stop.clear()
+    flush_failures = 0
+    flush_task = asyncio.create_task(flush_tracked_events())
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Let the flusher finish its current batch instead of cancelling it mid-write
+    flush_stop.set()
+    if flush_task is not None:
+        await flush_task
+    if redis_client is not None:
+        await drain_track_queue()
+        if track_queue:
+            log.error("Dropping %d unflushed events on shutdown", len(track_queue))
+        await redis_client.aclose()
+    if openai_client is not None:
+        await openai_client.close()
+
 @app.get("/")
-async def root():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+async def root() -> HealthResponse:
+    return HealthResponse(status="healthy", timestamp=int(time.time()))
 
 @app.get("/health")
-async def health_check():
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+async def health_check() -> HealthResponse:
+    return HealthResponse(status="healthy", timestamp=int(time.time()))
 
 @app.post("/track")
-async def track_event(request: Request):
+async def track_event(event: TrackingEvent, request: Request) -> TrackResponse:
     """Receive and store tracking events from frontend"""
-    try:
-        body = await request.body()
-        event_data = json.loads(body.decode())
-        
-        session_id = event_data.get("session_id")
-        
-        if session_id not in sessions_store:
-            sessions_store[session_id] = {
-                "events": [],
-                "created_at": time.time(),
-                "last_activity": time.time()
-            }
-        
-        sessions_store[session_id]["events"].append(event_data)
-        sessions_store[session_id]["last_activity"] = time.time()
-        
-        return {"status": "success", "session_id": session_id}
-        
-    except Exception as e:
-        return {"error": str(e)}
+    global rejected_events
+    if len(track_queue) >= TRACK_QUEUE_MAX:
+        if rejected_events == 0:
+            log.warning("Track queue full (%d events), rejecting new events", len(track_queue))
+        rejected_events += 1
+        raise HTTPException(status_code=503, detail="Tracking queue full")
+    
+    # The body was already read (and cached) to validate the event; keep the
+    # original bytes rather than re-serialising the model
+    track_queue.append((event, await request.body()))
+    
+    return TrackResponse(status="queued", session_id=event.session_id)
 
 @app.post("/analyze")
-async def analyze_session(request: Request):
+async def analyze_session(req: AnalyzeRequest) -> Union[AIResponse, ErrorResponse]:
     """Analyze session data and get AI decision"""
-    try:
-        body = await request.body()
-        request_data = json.loads(body.decode())
-        session_id = request_data.get("session_id")
-        
-        if session_id not in sessions_store:
-            return {"error": "Session not found"}
-        
-        session_data = sessions_store[session_id]
-        events = session_data["events"]
-        
-        analysis = analyze_session_behavior(events)
-        ai_response = get_ai_decision(analysis)
-        
-        return {
-            "should_show_message": ai_response.should_show_message,
-            "message": ai_response.message,
-            "trigger_type": ai_response.trigger_type
-        }
-        
-    except Exception as e:
-        return {
-            "should_show_message": True,
-            "message": "Thanks for browsing! Get 15% off your first order!",
-            "trigger_type": "discount"
-        }
+    session_id = req.session_id
+
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.hgetall(session_meta_key(session_id))
+        pipe.lrange(session_events_key(session_id), 0, -1)
+        raw_meta, raw_recent_events = await pipe.execute()
+    
+    if not raw_meta or not raw_recent_events:
+        return ErrorResponse(error="Session not found")
+    
+    session_meta = {field.decode(): value for field, value in raw_meta.items()}
+    recent_events = [orjson.loads(raw) for raw in raw_recent_events]
+    
+    analysis = analyze_session_behavior(session_meta, recent_events)
+    return await get_ai_decision(analysis)
 
 @app.get("/sessions")
 async def get_sessions():
     """Debug endpoint to see all sessions"""
+    sessions = {}
+    async for key in redis_client.scan_iter(match=session_meta_key("*")):
+        session_id = key.decode().split(":", 2)[1]
+        events_count, last_activity = await redis_client.hmget(key, "total_events", "last_activity")
+        sessions[session_id] = {
+            "events_count": int(events_count) if events_count else 0,
+            "last_activity": int(last_activity) if last_activity else None
+        }
+    
     return {
-        "total_sessions": len(sessions_store),
-        "sessions": {k: {"events_count": len(v["events"]), "last_activity": v["last_activity"]} 
-                    for k, v in sessions_store.items()}
+        "total_sessions": len(sessions),
+        "sessions": sessions
     }
 
-def analyze_session_behavior(events: List[Dict]) -> Dict:
-    """Analyze session behavior patterns"""
-    if not events:
+def analyze_session_behavior(session_meta: Dict[str, bytes], recent_events: List[Dict]) -> Dict:
+    """Build the session analysis from stored counters and recent events"""
+    if not recent_events:
         return {}
-    page_views = [e for e in events if e["event_type"] == "page_view"]
-    clicks = [e for e in events if e["event_type"] == "click"]
-    cart_actions = [e for e in events if e["event_type"] == "add_to_cart"]
     
-    session_duration = events[-1]["timestamp"] - events[0]["timestamp"]
+    def counter(field: str) -> int:
+        return int(session_meta.get(field, 0))
     
-    product_pages = [e for e in page_views if e.get("page_type") == "product"]
-    cart_pages = [e for e in page_views if e.get("page_type") == "cart"]
+    session_duration = float(session_meta["last_event_at"]) - float(session_meta["first_event_at"])
+    cart_actions = counter("cart_actions")
     
     analysis = {
-        "total_events": len(events),
-        "page_views": len(page_views),
-        "clicks": len(clicks),
-        "cart_actions": len(cart_actions),
+        "total_events": counter("total_events"),
+        "page_views": counter("page_views"),
+        "clicks": counter("clicks"),
+        "cart_actions": cart_actions,
         "session_duration": session_duration,
-        "product_page_views": len(product_pages),
-        "cart_page_views": len(cart_pages),
-        "current_page": events[-1].get("page_type", "unknown"),
-        "has_cart_items": len(cart_actions) > 0,
-        "events": events[-5:]  
+        "product_page_views": counter("product_page_views"),
+        "cart_page_views": counter("cart_page_views"),
+        "current_page": session_meta["current_page"].decode(),
+        "has_cart_items": cart_actions > 0,
+        "events": recent_events
     }
     
     return analysis
 
-def get_ai_decision(analysis: Dict) -> AIResponse:
+def parse_ai_decision(ai_text: str) -> Dict:
+    """Parse the model's JSON reply, falling back to regex extraction"""
+    try:
+        return orjson.loads(ai_text)
+    except orjson.JSONDecodeError:
+        message_match = MESSAGE_RE.search(ai_text)
+        trigger_match = TRIGGER_TYPE_RE.search(ai_text)
+        return {
+            "should_show_message": SHOW_MESSAGE_RE.search(ai_text) is not None,
+            "message": message_match.group(1) if message_match else None,
+            "trigger_type": trigger_match.group(1) if trigger_match else None
+        }
+
+async def get_ai_decision(analysis: Dict) -> AIResponse:
     """Use OpenAI to decide if and what message to show"""
     
+    # Only ask the model about ambiguous sessions: thin sessions without a cart
+    # and fresh add-to-carts are already decided by the fallback rules
+    has_cart = analysis.get("has_cart_items", False)
+    if (not has_cart and analysis.get("total_events", 0) < 3) or \
+            (has_cart and analysis.get("session_duration", 0) < 5):
+        return get_fallback_decision(analysis)
+    
     try:
-        from openai import OpenAI
-
-        api_key = os.getenv("OPENAI_API_KEY")
-        if not api_key:
+        if openai_client is None:
             return get_fallback_decision(analysis)
 
-        client = OpenAI(api_key=api_key)
-        
-        prompt = f"""
-You are an AI assistant helping an e-commerce store engage customers at the right moment.
-
-Analyze this user session data and decide if you should show an engagement message:
-
-Session Analysis:
-- Total page views: {analysis.get('page_views', 0)}
-- Total clicks: {analysis.get('clicks', 0)}
-- Products viewed: {analysis.get('product_page_views', 0)}
-- Cart interactions: {analysis.get('cart_actions', 0)}
-- Session duration: {analysis.get('session_duration', 0):.1f} seconds
-- Current page type: {analysis.get('current_page', 'unknown')}
-- Has items in cart: {analysis.get('has_cart_items', False)}
-
-Rules for engagement:
-1. Don't be annoying - only show messages when it adds value
-2. Consider user behavior patterns (hesitation, high engagement, etc.)
-3. Time messages appropriately (not too early, not too late)
-4. Personalize based on behavior
+        cache_key = ai_cache_key(analysis)
+        cached = await redis_client.get(cache_key)
+        if cached is not None:
+            return AIResponse.model_validate_json(cached)
 
-Respond in JSON format:
-{{
-    "should_show_message": true/false,
-    "message": "Your personalized message here (max 50 words)",
-    "reasoning": "Brief explanation of why",
-    "trigger_type": "discount" | "help" | "urgency" | "recommendation" | null
-}}
-"""
+        prompt = PROMPT_TEMPLATE.format_map({**PROMPT_DEFAULTS, **analysis})
 
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "You are a smart e-commerce engagement assistant."},
-                {"role": "user", "content": prompt}
-            ],
-            max_tokens=200,
-            temperature=0.7
-        )
+        for attempt in range(OPENAI_MAX_ATTEMPTS):
+            try:
+                async with openai_semaphore:
+                    response = await openai_client.chat.completions.create(
+                        model="gpt-3.5-turbo",
+                        messages=[
+                            SYSTEM_MESSAGE,
+                            {"role": "user", "content": prompt}
+                        ],
+                        max_tokens=200,
+                        temperature=0.7,
+                        response_format={"type": "json_object"}
+                    )
+                break
+            except (RateLimitError, APIConnectionError, InternalServerError):
+                if attempt == OPENAI_MAX_ATTEMPTS - 1:
+                    raise
+                await asyncio.sleep(2 ** attempt)
         
         ai_text = response.choices[0].message.content
         
-        if "should_show_message\": true" in ai_text:
-            import re
-            message_match = re.search(r'"message":\s*"([^"]+)"', ai_text)
-            trigger_match = re.search(r'"trigger_type":\s*"([^"]+)"', ai_text)
-            
-            message = message_match.group(1) if message_match else "Special offer just for you!"
-            trigger_type = trigger_match.group(1) if trigger_match else "discount"
+        decision = parse_ai_decision(ai_text)
+        if decision.get("should_show_message"):
+            message = decision.get("message") or "Special offer just for you!"
+            trigger_type = decision.get("trigger_type") or "discount"
             
-            return AIResponse(
+            ai_response = AIResponse(
                 should_show_message=True,
                 message=message,
                 trigger_type=trigger_type
             )
         else:
-            return AIResponse(should_show_message=False)
+            ai_response = AIResponse(should_show_message=False)
+
+        await redis_client.setex(cache_key, AI_CACHE_TTL, ai_response.model_dump_json())
+        return ai_response
             
     except Exception as e:
+        log.warning("AI decision error: %s", e)
         return get_fallback_decision(analysis)
 
 def get_fallback_decision(analysis: Dict) -> AIResponse:
@@ -250,4 +491,7 @@ def get_fallback_decision(analysis: Dict) -> AIResponse:
 # Run the server
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
+    # DEV=1 enables auto-reload (single process); otherwise run one worker per CPU
+    dev = bool(os.getenv("DEV"))
+    workers = 1 if dev else (os.cpu_count() or 1)
+    uvicorn.run("modal_app:app", host="0.0.0.0", port=8000, reload=dev, workers=workers)
@@ -2,12 +2,19 @@
 Simple runner script for the Melingo FastAPI app (Local Version)
 """
 
+import os
+
 if __name__ == "__main__":
     import uvicorn
     
+    # DEV=1 enables auto-reload (single process); otherwise run one worker per CPU
+    dev = bool(os.getenv("DEV"))
+    workers = 1 if dev else (os.cpu_count() or 1)
+    
     print("🚀 Starting Melingo Engagement API (Local Server)...")
     print("📝 API Documentation: http://localhost:8000/docs")
     print("🌐 API running at: http://localhost:8000")
     print("🔧 No Modal required - running as standard FastAPI server!")
+    print(f"⚙️  Mode: {'development (auto-reload)' if dev else f'{workers} workers'}")
     
-    uvicorn.run("local_app:app", host="0.0.0.0", port=8000, reload=True)
+    uvicorn.run("local_app:app", host="0.0.0.0", port=8000, reload=dev, workers=workers)